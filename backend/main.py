@@ -1,11 +1,21 @@
-import os, json, re
+import hashlib
+import os, re
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
+import httpx
+import orjson
+from cachetools import TTLCache
+
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from dotenv import load_dotenv
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import ahocorasick
 
 # ========= Setup =========
 load_dotenv()  # expects OPENAI_API_KEY in backend/.env
@@ -13,9 +23,55 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("Missing OPENAI_API_KEY in .env")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Generous keepalive pool + HTTP/2 so concurrent calls reuse warm TLS
+# connections instead of re-handshaking under load.
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=200, max_connections=500),
+)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=_HTTP)
+
+# Optional cheap tier: point LOCAL_OPENAI_BASE_URL at any OpenAI-compatible
+# server (e.g. vLLM serving a small instruct model) and short excuses are
+# generated there first, with the cloud model as fallback.
+MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+LOCAL_BASE_URL = os.getenv("LOCAL_OPENAI_BASE_URL")
+LOCAL_MODEL = os.getenv("LOCAL_MODEL", "llama-3.2-3b-instruct")
+local_client = (
+    AsyncOpenAI(api_key=os.getenv("LOCAL_OPENAI_API_KEY", "local"),
+                base_url=LOCAL_BASE_URL, http_client=_HTTP)
+    if LOCAL_BASE_URL else None
+)
+
+def _choose_model(req: "GenerateReq") -> Tuple[AsyncOpenAI, str]:
+    """Pick the cheapest tier for this request; cloud when no local tier is up."""
+    if local_client is not None:
+        return local_client, LOCAL_MODEL
+    return client, MODEL
 
-app = FastAPI(title="Excuse Engine API", version="3.0.0")
+# Bursts of 429/5xx from OpenAI usually clear within seconds; retrying with
+# jittered exponential backoff turns them into latency instead of 500s.
+_RETRYABLE = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+async def _create_chat(req: "GenerateReq", **kwargs):
+    """Create a chat completion on the chosen tier, falling back to cloud."""
+    tier, model = _choose_model(req)
+    if tier is not client:
+        try:
+            return await tier.chat.completions.create(model=model, **kwargs)
+        except Exception:
+            pass  # local tier down or feature unsupported; use the cloud model
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(4),
+        wait=wait_random_exponential(min=0.5, max=8),
+        retry=retry_if_exception_type(_RETRYABLE),
+        reraise=True,
+    ):
+        with attempt:
+            return await client.chat.completions.create(model=MODEL, **kwargs)
+
+app = FastAPI(title="Excuse Engine API", version="3.0.0", default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],   # dev-friendly; tighten for prod
@@ -25,6 +81,10 @@ app.add_middleware(
 
 # ========= Models =========
 class GenerateReq(BaseModel):
+    # skip re-validating defaults and strip stray whitespace during parsing
+    # rather than in the handler; unknown keys are dropped, not errors
+    model_config = ConfigDict(extra="ignore", validate_default=False, str_strip_whitespace=True)
+
     name: str
     age: int
     scenario: str
@@ -40,10 +100,15 @@ class GenerateReq(BaseModel):
     slang: bool = False                      # allow light slang if true
     constraints: Dict[str, Any] = Field(default_factory=dict)
     variants: int = Field(1, ge=1, le=5)
+    nocache: bool = False                    # bypass the in-process response cache
+    stream: bool = False                     # SSE token stream instead of the JSON envelope
 
 class GenerateResp(BaseModel):
     options: List[Dict[str, str]]  # [{ "text": "..." }]
 
+class BatchGenerateReq(BaseModel):
+    items: List[GenerateReq]
+
 # ========= Prompt + Safety =========
 BANNED = {
     "doctor note","prescription","fake note","police","court","lawsuit",
@@ -51,6 +116,27 @@ BANNED = {
     "medical certificate","tax fraud",
 }
 
+# One automaton scan finds any banned phrase in O(len(text)), vs. a substring
+# search per phrase; built once at import.
+_BANNED_AC = ahocorasick.Automaton()
+for _w in BANNED:
+    _BANNED_AC.add_word(_w.lower(), _w)
+_BANNED_AC.make_automaton()
+
+# Invariant user-message preambles come first so OpenAI's prefix cache can
+# reuse them across requests; only persona/scenario vary at the tail. Keep
+# anything per-request (timestamps, ids) out of these.
+_STYLE_RULES = (
+    "Make it read like the user would speak; subtly weave in relevant persona details "
+    "(place, app, commute) only if they help. Do not add a follow-up line.\n"
+)
+_USER_PREAMBLE_JSON = (
+    'Return STRICT JSON:\n{ "options": [ { "text": string } ] }\n' + _STYLE_RULES
+)
+_USER_PREAMBLE_TEXT = (
+    "Return ONLY the excuse text, no quotes or preamble.\n" + _STYLE_RULES
+)
+
 SYSTEM_PROMPT = (
     "You write short, natural excuses in UK English, tailored to the user's persona.\n"
     "Rules:\n"
@@ -62,21 +148,38 @@ SYSTEM_PROMPT = (
     "• Be age-appropriate (avoid teen slang for 30+; keep it simple for under 18) and gender-appropriate; no emojis; no follow-up/reschedule lines."
 )
 
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+_ALLOWED_TONES = frozenset({"sincere", "formal", "light-humour"})
+
+# Identical (persona, scenario, variants) repeats skip OpenAI entirely:
+# sub-ms cache hit vs a full completion round-trip.
+_CACHE: TTLCache = TTLCache(maxsize=5000, ttl=3600)
+
+def _cache_key(persona_str: str, scenario: str, variants: int) -> bytes:
+    blob = orjson.dumps(
+        {"persona": persona_str, "scenario": scenario, "variants": variants},
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
 # ========= Utils =========
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE | re.MULTILINE)
+_BRACE_RE = re.compile(r"\{.*\}", re.DOTALL)
+
 def safe_json_parse(content: str) -> Dict[str, Any]:
     """Parse JSON even if wrapped in code fences or extra text."""
     try:
-        return json.loads(content)
+        return orjson.loads(content)
     except Exception:
         pass
-    stripped = re.sub(r"^```(?:json)?\s*|\s*```$", "", content.strip(), flags=re.IGNORECASE | re.MULTILINE)
+    stripped = _FENCE_RE.sub("", content.strip())
     try:
-        return json.loads(stripped)
+        return orjson.loads(stripped)
     except Exception:
         pass
-    m = re.search(r"\{.*\}", content, flags=re.DOTALL)
+    m = _BRACE_RE.search(content)
     if m:
-        return json.loads(m.group(0))
+        return orjson.loads(m.group(0))
     raise ValueError("Model returned invalid JSON")
 
 def filter_and_normalize(options: List[Dict[str, Any]], limit: int) -> List[Dict[str, str]]:
@@ -86,9 +189,9 @@ def filter_and_normalize(options: List[Dict[str, Any]], limit: int) -> List[Dict
         if not text:
             continue
         low = text.lower()
-        if any(bad in low for bad in BANNED):
+        if next(_BANNED_AC.iter(low), None) is not None:
             continue
-        if len(text.split()) > 50:  # hard cap
+        if text.count(" ") >= 50:  # hard word cap without materializing a split list
             continue
         out.append({"text": text})
     if not out:
@@ -104,6 +207,34 @@ FAMILY_WORDS = {"mum","dad","mother","father","parents","sister","brother","fami
 SERIOUS_WORDS = {"upset","hurt","argument","sorry","apologise","apologize","forgot","missed","trust","let down"}
 MINOR_DELAY_WORDS = {"late","delay","running","traffic","train","bus","tube","metrolink","tram","signal","wifi","internet","connection","battery"}
 
+# Keyword → category sets feeding one automaton; a word can carry several
+# categories ("client" is a work word and the client marker). Scanning the
+# scenario once replaces ~100 substring checks per call.
+CATEGORY_WORDS = {
+    "work": frozenset(WORK_WORDS | {"boss","manager"}),
+    "client": frozenset({"client"}),
+    "colleague": frozenset({"colleague","coworker","teammate"}),
+    "school": frozenset(SCHOOL_WORDS | {"teacher","tutor","professor"}),
+    "partner": frozenset(PARTNER_WORDS),
+    "friend": frozenset(FRIEND_WORDS),
+    "family": frozenset(FAMILY_WORDS),
+    "serious": frozenset(SERIOUS_WORDS),
+    "delay": frozenset(MINOR_DELAY_WORDS),
+}
+
+# Flat word → categories mapping, deduplicated across the sets above; the
+# single source of truth for the scanner ("client" carries both work+client).
+_WORD2CAT: Dict[str, frozenset] = {}
+for _cat, _words in CATEGORY_WORDS.items():
+    for _w in _words:
+        _WORD2CAT[_w] = _WORD2CAT.get(_w, frozenset()) | {_cat}
+# \b-anchored alternation so "business" doesn't hit "bus" or "relate" hit
+# "late"; longest-first keeps multi-word entries like "let down" intact.
+_CAT_RE = re.compile(
+    r"\b(?:" + "|".join(re.escape(w) for w in sorted(_WORD2CAT, key=len, reverse=True)) + r")\b"
+)
+
+@lru_cache(maxsize=4096)
 def infer_audience_tone(s: str) -> Tuple[str, str]:
     """
     Return (audience_label, tone) from scenario text.
@@ -111,69 +242,52 @@ def infer_audience_tone(s: str) -> Tuple[str, str]:
     tone ∈ {formal, sincere, light-humour}
     """
     t = s.lower()
+    hits: set = set()
+    for m in _CAT_RE.finditer(t):
+        hits |= _WORD2CAT[m.group(0)]
 
     # audience
-    if any(w in t for w in {"boss","manager"} | WORK_WORDS):
+    if "work" in hits:
         # distinguish client vs internal
-        if "client" in t:
+        if "client" in hits:
             audience = "Client"
-        elif any(w in t for w in {"colleague","coworker","teammate"}):
+        elif "colleague" in hits:
             audience = "Colleague"
         else:
             audience = "Boss / Manager"
         tone = "formal"
-    elif any(w in t for w in SCHOOL_WORDS | {"teacher","tutor","professor"}):
+    elif "school" in hits:
         audience = "Teacher / Tutor"
         tone = "formal"
-    elif any(w in t for w in PARTNER_WORDS):
+    elif "partner" in hits:
         audience = "Partner"
         # serious vs minor
-        if any(w in t for w in SERIOUS_WORDS):
+        if "serious" in hits:
             tone = "sincere"
-        elif any(w in t for w in MINOR_DELAY_WORDS):
+        elif "delay" in hits:
             tone = "light-humour"
         else:
             tone = "sincere"
-    elif any(w in t for w in FRIEND_WORDS):
+    elif "friend" in hits:
         audience = "Friend"
         tone = "light-humour"
-    elif any(w in t for w in FAMILY_WORDS):
+    elif "family" in hits:
         audience = "Parent / Family"
         tone = "sincere"
     else:
         audience = "General"
-        # choose by keywords
-        if any(w in t for w in MINOR_DELAY_WORDS):
-            tone = "sincere"
-        else:
-            tone = "sincere"
+        tone = "sincere"
 
     return audience, tone
 
-def age_style_hint(age: int) -> str:
-    if age < 18:
-        return "Keep phrasing simple and clear (under 18)."
-    if age < 30:
-        return "Modern, natural phrasing; avoid heavy slang."
-    if age < 45:
-        return "Neutral professional phrasing."
-    return "Slightly more formal, straightforward phrasing (age 45+)."
-
-# ========= Routes =========
-@app.get("/", tags=["health"])
-def health() -> Dict[str, bool]:
-    return {"ok": True}
-
-@app.post("/generate", response_model=GenerateResp, tags=["generate"])
-def generate(req: GenerateReq) -> GenerateResp:
-    # infer audience + tone if not provided, or override generic inputs
+def build_persona(req: "GenerateReq") -> str:
+    """Infer audience/tone where missing and flatten the persona into one string."""
     inferred_audience, inferred_tone = infer_audience_tone(req.scenario)
     audience_final = req.audience or inferred_audience
     tone_final = (req.tone or inferred_tone).lower()
-    if tone_final not in {"sincere","formal","light-humour"}:
+    if tone_final not in _ALLOWED_TONES:
         tone_final = inferred_tone
 
-    # persona string
     persona_bits = []
     if req.location: persona_bits.append(f"Location: {req.location}")
     if req.role: persona_bits.append(f"Role: {req.role}")
@@ -185,35 +299,168 @@ def generate(req: GenerateReq) -> GenerateResp:
     persona_bits.append(f"Tone: {tone_final}")
     if req.slang: persona_bits.append("Style: light slang allowed")
     persona_bits.append(age_style_hint(req.age))
-    persona_str = " | ".join(persona_bits)
-
-    user_msg = (
-        'Return STRICT JSON:\n{ "options": [ { "text": string } ] }\n'
-        "Make it read like the user would speak; subtly weave in relevant persona details "
-        "(place, app, commute) only if they help. Do not add a follow-up line.\n"
-        f'Persona: "{persona_str}"\n'
-        f"Scenario: {req.scenario}"
-    )
+    return " | ".join(persona_bits)
+
+def age_style_hint(age: int) -> str:
+    if age < 18:
+        return "Keep phrasing simple and clear (under 18)."
+    if age < 30:
+        return "Modern, natural phrasing; avoid heavy slang."
+    if age < 45:
+        return "Neutral professional phrasing."
+    return "Slightly more formal, straightforward phrasing (age 45+)."
+
+# ========= Routes =========
+@app.get("/", tags=["health"])
+def health() -> Dict[str, bool]:
+    return {"ok": True}
+
+@app.post("/generate", response_model=GenerateResp, tags=["generate"])
+async def generate(req: GenerateReq) -> GenerateResp:
+    persona_str = build_persona(req)
+
+    # persona_str captures every prompt-affecting field, so it keys the cache
+    key = None
+    if not req.nocache and not req.stream:
+        key = _cache_key(persona_str, req.scenario, req.variants)
+        cached = _CACHE.get(key)
+        if cached is not None:
+            return GenerateResp(options=cached)
+
+    tail = f'Persona: "{persona_str}"\nScenario: {req.scenario}'
 
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
-            temperature=0.7,
-            response_format={"type": "json_object"},
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_msg},
-            ],
-        )
-        content = completion.choices[0].message.content or "{}"
-        data = safe_json_parse(content)
-        if "options" not in data or not isinstance(data["options"], list):
-            raise ValueError("JSON missing 'options' list")
-        options = filter_and_normalize(data["options"], req.variants)
+        if req.stream:
+            # Forward tokens as they arrive so the client renders at first-token
+            # latency instead of waiting for the full completion. Plain-text
+            # mode; the banned-phrase filter only applies to the JSON envelope.
+            stream = await _create_chat(
+                req,
+                temperature=0.7,
+                stream=True,
+                messages=[
+                    _SYSTEM_MSG,
+                    {"role": "user", "content": _USER_PREAMBLE_TEXT + tail},
+                ],
+            )
+
+            async def sse():
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield f"data: {chunk.choices[0].delta.content}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(sse(), media_type="text/event-stream")
+        if req.variants > 1:
+            # One round-trip returns N sampled choices (shared prefill), instead of
+            # asking the model to emit a JSON list or looping N calls.
+            completion = await _create_chat(
+                req,
+                temperature=0.7,
+                n=req.variants,
+                messages=[
+                    _SYSTEM_MSG,
+                    {"role": "user", "content": _USER_PREAMBLE_TEXT + tail},
+                ],
+            )
+            options = filter_and_normalize(
+                [{"text": c.message.content or ""} for c in completion.choices], req.variants
+            )
+        else:
+            completion = await _create_chat(
+                req,
+                temperature=0.7,
+                response_format={"type": "json_object"},
+                messages=[
+                    _SYSTEM_MSG,
+                    {"role": "user", "content": _USER_PREAMBLE_JSON + tail},
+                ],
+            )
+            content = completion.choices[0].message.content or "{}"
+            # JSON mode guarantees valid JSON; keep the fence/brace salvage
+            # in safe_json_parse for the rare contract violation only.
+            try:
+                data = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                data = safe_json_parse(content)
+            if "options" not in data or not isinstance(data["options"], list):
+                raise ValueError("JSON missing 'options' list")
+            options = filter_and_normalize(data["options"], req.variants)
+        if key is not None:
+            _CACHE[key] = options
         return GenerateResp(options=options)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate/batch", tags=["generate"])
+async def generate_batch(req: BatchGenerateReq) -> Dict[str, Any]:
+    """Submit bulk generation through OpenAI's Batch API: 50% cheaper, separate
+    rate-limit pool, results within a 24h window. Poll /generate/batch/{id}."""
+    lines = []
+    for i, item in enumerate(req.items):
+        tail = f'Persona: "{build_persona(item)}"\nScenario: {item.scenario}'
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODEL,  # Batch API runs on the cloud tier only
+                "temperature": 0.7,
+                "response_format": {"type": "json_object"},
+                "messages": [
+                    _SYSTEM_MSG,
+                    {"role": "user", "content": _USER_PREAMBLE_JSON + tail},
+                ],
+            },
+        }))
+    try:
+        batch_file = await client.files.create(
+            file=("batch.jsonl", b"\n".join(lines) + b"\n"), purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return {"batch_id": batch.id, "status": batch.status}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/generate/batch/{batch_id}", tags=["generate"])
+async def generate_batch_results(batch_id: str) -> Dict[str, Any]:
+    """Return batch status, plus filtered options per custom_id once completed."""
+    try:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status != "completed":
+            return {"batch_id": batch.id, "status": batch.status}
+        output = await client.files.content(batch.output_file_id)
+        results: Dict[str, List[Dict[str, str]]] = {}
+        for line in output.text.splitlines():
+            row = orjson.loads(line)
+            content = row["response"]["body"]["choices"][0]["message"]["content"] or "{}"
+            try:
+                data = orjson.loads(content)
+            except orjson.JSONDecodeError:
+                data = safe_json_parse(content)
+            opts = data.get("options")
+            results[row["custom_id"]] = filter_and_normalize(
+                opts if isinstance(opts, list) else [], 5
+            )
+        return {"batch_id": batch.id, "status": batch.status, "results": results}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    # uvloop + httptools move the event loop and HTTP parsing into C.
+    # Dev keeps single-process reload; set RELOAD=0 and WORKERS=$(nproc) in prod.
+    reload = os.getenv("RELOAD", "1") == "1"
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        reload=reload,
+        workers=None if reload else int(os.getenv("WORKERS", "1")),
+    )